@@ -5,7 +5,7 @@
 """
 
 import collections
-import six
+import functools
 import numpy as np
 
 from pysc2.lib import features
@@ -13,10 +13,45 @@ from pysc2.lib import stopwatch
 from pysc2.lib import static_data
 from pysc2.lib import named_array
 
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 sw = stopwatch.sw
 
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def _cast_copy(dst, src):
+        for i in range(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                dst[i, j] = src[i, j]
+else:
+    def _cast_copy(dst, src):
+        np.copyto(dst, src, casting='unsafe')
+
+
+def _write_layer(dst, layer):
+    """Write one unpacked (y, x) layer into its destination slice."""
+    if layer is None:
+        dst.fill(0)
+    else:
+        _cast_copy(dst, layer)
+
+
+@functools.lru_cache(maxsize=None)
+def _palette(fn, scale):
+    """Memoize palette construction; palettes only depend on (fn, scale)."""
+    return fn(scale)
+
+
 class SpatialFeatures(collections.namedtuple("SpatialFeatures", [
         "height_map", "visibility_map", "creep", "camera",
         "player_id", "player_relative", "selected", "unit_type"])):
@@ -28,19 +63,24 @@ class SpatialFeatures(collections.namedtuple("SpatialFeatures", [
 
     def __new__(cls, **kwargs):
         feats = {}
-        for name, (scale, type_, palette) in six.iteritems(kwargs):
+        for name, (scale, type_, palette) in kwargs.items():
             feats[name] = features.Feature(
-                index=SpatialFeatures._fields.index(name),
+                index=_SF_INDEX[name],
                 name=name,
                 layer_set="minimap_renders",
                 full_name="spatial " + name,
                 scale=scale,
                 type=type_,
-                palette=palette(scale) if callable(palette) else palette,
+                palette=_palette(palette, scale) if callable(palette) else palette,
                 clip=False,
             )
 
-        return super(SpatialFeatures, cls).__new__(cls, **feats)  # pytype: disable=missing-parameter
+        # Build positionally in field order, bypassing namedtuple.__new__'s
+        # keyword-argument handling.
+        return tuple.__new__(cls, tuple(feats[name] for name in cls._fields))
+
+
+_SF_INDEX = {name: i for i, name in enumerate(SpatialFeatures._fields)}
 
 
 SPATIAL_FEATURES = SpatialFeatures(
@@ -54,20 +94,109 @@ SPATIAL_FEATURES = SpatialFeatures(
     unit_type=(max(static_data.UNIT_TYPES) + 1, features.FeatureType.CATEGORICAL, features.colors.unit_type)
 )
 
+# Smallest signed dtype that can hold every layer's 'scale' (int16 as of
+# now). Signed, because torch.from_numpy rejects uint16 and the training
+# pipeline loads these arrays through it; layer values are all < scale, so
+# int16 still halves memory traffic vs. int32 at identical bandwidth.
+_SPATIAL_DTYPE = np.result_type(*(np.min_scalar_type(-f.scale) for f in SPATIAL_FEATURES))
+
+# Tile edge for the copy loop; a 32x32 uint16 tile is 2 KB, so one tile of
+# every layer fits in L1 together on large (128+) minimap resolutions.
+_TILE = 32
+
+# Renderer templates specialized per CustomFeatures instance: the feature
+# count is baked in as a constant and the buffers/unpackers are bound as
+# default arguments, leaving no shape or attribute lookups in the hot loop.
+# The single-tile variant (minimap <= 32) skips the source staging list.
+_RENDER_SPATIAL_TILED_SRC = """\
+def _render_spatial(renders, _names=_names, _unpack_layer=_unpack_layer,
+                    _srcs=_srcs, _tiles=_tiles, _buf=_buf, _write_layer=_write_layer):
+    for i in range({n}):
+        src = _unpack_layer[i](getattr(renders, _names[i]))
+        if src is None:
+            _buf[i].fill(0)  # one contiguous memset instead of per-tile fills
+        _srcs[i] = src
+    for ys, xs in _tiles:
+        for i in range({n}):
+            src = _srcs[i]
+            if src is not None:
+                _write_layer(_buf[i, ys, xs], src[ys, xs])
+"""
+
+_RENDER_SPATIAL_FLAT_SRC = """\
+def _render_spatial(renders, _names=_names, _unpack_layer=_unpack_layer,
+                    _buf=_buf, _write_layer=_write_layer):
+    for i in range({n}):
+        _write_layer(_buf[i], _unpack_layer[i](getattr(renders, _names[i])))
+"""
+
 
 class CustomFeatures(features.Features):
     """
     Render feature layer from SC2 Observation protos into numpy arrays.
     Check the documentation under 'pysc2.lib.features.Features'.
     """
-    def __init__(self, agent_interface_format=None, map_size=None):
+    def __init__(self, agent_interface_format=None, map_size=None, device='cpu'):
         super(CustomFeatures, self).__init__(agent_interface_format, map_size)
 
-        if self._agent_interface_format.feature_dimensions:
-            pass
-        if self._agent_interface_format.rgb_dimensions:
+        if device not in ('cpu', 'cuda'):
+            raise ValueError("Argument 'device' must be one of 'cpu' or 'cuda'.")
+        if device == 'cuda' and cupy is None:
+            device = 'cpu'  # CuPy unavailable; fall back to host rendering.
+        self._device = device
+
+        aif = self._agent_interface_format
+        if aif.feature_dimensions:
+            # Cache per-feature bound methods and the output shape once;
+            # 'custom_transform_obs' runs thousands of times per replay.
+            # 'unpack_layer' works straight off the minimap_renders proto,
+            # skipping Feature.unpack's per-layer attribute descent.
+            self._spatial_layer_names = tuple(f.name for f in SPATIAL_FEATURES)
+            self._spatial_unpack_layer = tuple(f.unpack_layer for f in SPATIAL_FEATURES)
+            self._spatial_shape = (
+                len(SPATIAL_FEATURES),
+                aif.feature_dimensions.minimap.y,
+                aif.feature_dimensions.minimap.x
+            )
+            # Rendered into in place every step; consumers that keep a
+            # frame beyond the current step must take a copy.
+            if self._device == 'cuda':
+                self._spatial_buf = cupy.empty(self._spatial_shape, dtype=_SPATIAL_DTYPE)
+            else:
+                self._spatial_buf = np.empty(self._spatial_shape, dtype=_SPATIAL_DTYPE)
+                # copy=False is forwarded to np.array so the named array is
+                # a real view of the render buffer (the default would snapshot
+                # it); the name-axis validation still runs only once.
+                self._spatial_named = named_array.NamedNumpyArray(
+                    self._spatial_buf, names=[SpatialFeatures, None, None], copy=False
+                )
+                n_feats, sy, sx = self._spatial_shape
+                self._spatial_srcs = [None] * n_feats
+                self._spatial_tiles = tuple(
+                    (slice(by, min(by + _TILE, sy)), slice(bx, min(bx + _TILE, sx)))
+                    for by in range(0, sy, _TILE)
+                    for bx in range(0, sx, _TILE)
+                )
+                self._render_spatial = self._build_render_spatial()
+        if aif.rgb_dimensions:
             raise NotImplementedError
 
+    def _build_render_spatial(self):
+        """Compile a spatial renderer specialized for this instance's shapes."""
+        template = (_RENDER_SPATIAL_FLAT_SRC if len(self._spatial_tiles) == 1
+                    else _RENDER_SPATIAL_TILED_SRC)
+        source = template.format(n=self._spatial_shape[0])
+        namespace = {
+            '_names': self._spatial_layer_names,
+            '_unpack_layer': self._spatial_unpack_layer,
+            '_srcs': self._spatial_srcs,
+            '_tiles': self._spatial_tiles,
+            '_buf': self._spatial_buf,
+            '_write_layer': _write_layer,
+        }
+        exec(compile(source, '<render_spatial>', 'exec'), namespace)  # pylint: disable=exec-used
+        return namespace['_render_spatial']
+
     def custom_observation_spec(self):
         """Customized observation spec with spatial features."""
         obs_spec = self.observation_spec()
@@ -90,17 +219,24 @@ class CustomFeatures(features.Features):
         out = self.transform_obs(obs)
         aif = self._agent_interface_format
 
-        def or_zeros(layer, size):
-            if layer is not None:
-                return layer.astype(np.int32, copy=False)
-            else:
-                return np.zeros((size.y, size.x), dtype=np.int32)
-
         if aif.feature_dimensions:
-            out['feature_spatial'] = named_array.NamedNumpyArray(
-                np.stack(or_zeros(f.unpack(obs.observation), aif.feature_dimensions.minimap) for f in SPATIAL_FEATURES),
-                names=[SpatialFeatures, None, None]
-            )
+            # Bind the renders submessage once instead of walking the
+            # obs.observation.feature_layer_data chain per feature.
+            renders = obs.observation.feature_layer_data.minimap_renders
+            if self._device == 'cuda':
+                # Copy each layer to the device buffer; agents consume the
+                # CuPy array directly without a second host->device hop.
+                buf = self._spatial_buf
+                for i, unpack_layer in enumerate(self._spatial_unpack_layer):
+                    layer = unpack_layer(getattr(renders, self._spatial_layer_names[i]))
+                    if layer is None:
+                        buf[i].fill(0)
+                    else:
+                        buf[i].set(np.ascontiguousarray(layer, dtype=buf.dtype))
+                out['feature_spatial'] = buf
+            else:
+                self._render_spatial(renders)
+                out['feature_spatial'] = self._spatial_named
 
         if aif.rgb_dimensions:
             raise NotImplementedError
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Output-equivalence tests for the specialized spatial renderer.
+    Run from the repository root: python -m features.custom_features_test
+"""
+
+import types
+import numpy as np
+
+from absl.testing import absltest
+from pysc2.lib import features
+
+from s2clientprotocol import common_pb2 as sc_common
+
+from features.custom_features import CustomFeatures
+from features.custom_features import SPATIAL_FEATURES
+
+
+def _make_features(size):
+    aif = features.AgentInterfaceFormat(
+        feature_dimensions=features.Dimensions(screen=(size, size), minimap=(size, size))
+    )
+    return CustomFeatures(agent_interface_format=aif)
+
+
+def _make_plane(sy, sx, scale, seed):
+    rng = np.random.RandomState(seed)
+    data = rng.randint(0, min(scale, 256), size=(sy, sx), dtype=np.uint8)
+    return sc_common.ImageData(
+        bits_per_pixel=8,
+        size=sc_common.Size2DI(x=sx, y=sy),
+        data=data.tobytes()
+    )
+
+
+def _make_renders(size, seed, missing=()):
+    """Build a synthetic minimap_renders stand-in for every spatial layer."""
+    planes = {}
+    for f in SPATIAL_FEATURES:
+        if f.name in missing:
+            planes[f.name] = sc_common.ImageData()  # length-0 plane
+        else:
+            planes[f.name] = _make_plane(size, size, f.scale, seed + f.index)
+    return types.SimpleNamespace(**planes)
+
+
+def _baseline(renders, size):
+    """Reference rendering: stack of Feature.unpack_layer results."""
+    layers = []
+    for f in SPATIAL_FEATURES:
+        layer = f.unpack_layer(getattr(renders, f.name))
+        if layer is None:
+            layer = np.zeros((size, size), dtype=np.int32)
+        layers.append(layer)
+    return np.stack(layers)
+
+
+class RenderSpatialTest(absltest.TestCase):
+
+    def _assert_matches_baseline(self, size, seed, missing=()):
+        feats = _make_features(size)
+        renders = _make_renders(size, seed, missing=missing)
+        feats._render_spatial(renders)
+        np.testing.assert_array_equal(
+            np.asarray(feats._spatial_buf), _baseline(renders, size)
+        )
+
+    def test_flat_renderer_matches_unpack(self):
+        # size <= tile edge -> single tile -> flat variant
+        self._assert_matches_baseline(size=32, seed=0)
+
+    def test_tiled_renderer_matches_unpack(self):
+        self._assert_matches_baseline(size=64, seed=10)
+
+    def test_tiled_renderer_zeroes_missing_layers(self):
+        self._assert_matches_baseline(size=64, seed=20, missing=('creep', 'camera'))
+
+    def test_named_array_views_render_buffer(self):
+        feats = _make_features(64)
+        self.assertTrue(np.shares_memory(feats._spatial_buf, feats._spatial_named))
+
+    def test_named_array_tracks_buffer_across_frames(self):
+        size = 64
+        feats = _make_features(size)
+        feats._render_spatial(_make_renders(size, seed=30))
+        first_frame = np.asarray(feats._spatial_named).copy()
+        feats._render_spatial(_make_renders(size, seed=40))
+        np.testing.assert_array_equal(
+            np.asarray(feats._spatial_named), _baseline(_make_renders(size, seed=40), size)
+        )
+        self.assertTrue((np.asarray(feats._spatial_named) != first_frame).any())
+
+
+if __name__ == '__main__':
+    absltest.main()
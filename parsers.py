@@ -126,7 +126,8 @@ class SpatialFeatParser(ParserBase):
         spatial = timestep.observation['feature_spatial']
         name2idx = spatial._index_names[0]  # name: index
         for name, _ in name2idx.items():
-            self.spatial_features[name].append(spatial[name])
+            # 'feature_spatial' is rendered into a reused buffer; snapshot it.
+            self.spatial_features[name].append(spatial[name].copy())
 
     def _save_spatial_features(self, format_):
         """Save 'spatial' to .npz format."""
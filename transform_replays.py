@@ -10,10 +10,14 @@ from __future__ import print_function
 
 import os
 import sys
-import glob
 import json
+import mmap
+import multiprocessing.util
 import time
+import functools
+import itertools
 import collections
+import concurrent.futures
 import websocket
 import numpy as np
 
@@ -43,10 +47,13 @@ flags.DEFINE_string('result_dir', default='./parsed/', help='Directory to write
 flags.DEFINE_integer('screen_size', default=64, help='Size of game screen.')
 flags.DEFINE_integer('minimap_size', default=64, help='Size of minimap.')
 flags.DEFINE_integer('step_mul', default=4, help='Sample interval.')
+flags.DEFINE_integer('obs_every', default=1, help='Game steps batched per observation, in units of step_mul.')
 flags.DEFINE_integer('min_game_length', default=3000, help='Game length lower bound.')
 flags.DEFINE_integer('resume_from', default=0, help='Index of replay to resume from.')
 flags.DEFINE_float('discount', default=1., help='Not used.')
 flags.DEFINE_bool('override', default=False, help='Force overriding existing results.')
+flags.DEFINE_integer('n_workers', default=max(1, os.cpu_count() // 2),
+                     help='Number of parallel parsing processes; each worker owns one SC2 client.')
 
 flags.DEFINE_enum('race_matchup', default=None, enum_values=['TvT', 'TvP', 'TvZ', 'PvP', 'PvZ', 'ZvZ'], help='Race matchups.')
 flags.register_validator('race_matchup', lambda matchup: all([race in ['T', 'P', 'Z'] for race in matchup.split('v')]))
@@ -73,26 +80,30 @@ class ReplayRunner(object):
         https://github.com/narhen/pysc2-replay/blob/master/transform_replay.py
         https://github.com/deepmind/pysc2/blob/master/pysc2/bin/replay_actions.py
     """
-    def __init__(self, replay_file_path, parser_objects,
+    def __init__(self, parser_objects,
                  player_id=1, screen_size=(64, 64), minimap_size=(64, 64),
-                 discount=1., step_mul=1, override=False):
-
-        self.replay_file_path = os.path.abspath(replay_file_path)
-        self.replay_name = os.path.split(replay_file_path)[-1].replace('.SC2Replay', '')
-        self.write_dir = os.path.join(FLAGS.result_dir, FLAGS.race_matchup, self.replay_name)
+                 discount=1., step_mul=1, obs_every=1, override=False,
+                 result_dir='./parsed/', race_matchup=None, min_game_length=3000):
 
         if isinstance(parser_objects, list):
-            self.parsers = [p_obj(self.write_dir) for p_obj in parser_objects]
+            self.parser_objects = parser_objects
         elif issubclass(parser_objects, ParserBase):
-            self.parsers = [parser_objects(self.write_dir)]
+            self.parser_objects = [parser_objects]
         else:
             raise ValueError("Argument 'parsers' expects a single or list of Parser objects.")
 
         self.player_id = player_id
         self.discount = discount
         self.step_mul = step_mul
+        self.obs_every = max(1, obs_every)
         self.override = override
 
+        # Flag values are handed in explicitly so worker processes never
+        # touch FLAGS (unparsed under the spawn start method).
+        self.result_dir = result_dir
+        self.race_matchup = race_matchup
+        self.min_game_length = min_game_length
+
         # Configure screen size
         if isinstance(screen_size, tuple):
             self.screen_size = screen_size
@@ -112,6 +123,9 @@ class ReplayRunner(object):
         assert len(self.screen_size) == 2
         assert len(self.minimap_size) == 2
 
+        self.screen_size = point.Point(*self.screen_size)
+        self.minimap_size = point.Point(*self.minimap_size)
+
         # Arguments for 'sc_process.StarCraftProcess'. Check the following:
         # https://github.com/deepmind/pysc2/blob/master/pysc2/lib/sc_process.py
 
@@ -120,6 +134,8 @@ class ReplayRunner(object):
             self.run_config = run_configs.get()
             self.sc2_process = self.run_config.start(**sc2_process_configs)
             self.controller = self.sc2_process.controller
+            # base_build is fixed for the lifetime of the client; ping once.
+            self._ping = self.controller.ping()
         except websocket.WebSocketTimeoutException as e:
             raise ConnectionRefusedError(f'Connection to SC2 process unavailable. ({e})')
         except protocol.ConnectionError as e:
@@ -130,17 +146,37 @@ class ReplayRunner(object):
         #   https://github.com/deepmind/pysc2/blob/master/pysc2/lib/sc_process.py
         #   https://github.com/deepmind/pysc2/blob/master/pysc2/lib/remote_controller.py
 
+    @staticmethod
+    def _read_replay_data(replay_file_path):
+        """
+        Read a replay file into a single bytes object.
+        Replays can be tens of MBs; map the file instead of a buffered read
+        and take the one bytes copy the protobuf API requires, straight off
+        the page cache. Callers must hand this same object to every request
+        (replay_info, RequestStartReplay) without re-casting, so the Python
+        heap only ever holds one copy per replay.
+        """
+        with open(replay_file_path, 'rb') as fh:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return bytes(mm)
+
+    def load(self, replay_file_path):
+        """Load a replay into the running SC2 process; reusable across files."""
+        self.replay_file_path = os.path.abspath(replay_file_path)
+        self.replay_name = os.path.split(replay_file_path)[-1].replace('.SC2Replay', '')
+        self.write_dir = os.path.join(self.result_dir, self.race_matchup, self.replay_name)
+        self.parsers = [p_obj(self.write_dir) for p_obj in self.parser_objects]
+
         # Load replay information & check validity.
-        replay_data = self.run_config.replay_data(self.replay_file_path)
+        replay_data = self._read_replay_data(self.replay_file_path)
         info = self.controller.replay_info(replay_data)
-        if not self.check_valid_replay(info, self.controller.ping()):
-            self.safe_escape()
+        # Invalid replays leave the SC2 process alive for the next 'load'.
+        if not self.check_valid_replay(info, self._ping):
             raise ValueError('Invalid replay.')
 
         # Filter replay by race matchup
-        if FLAGS.race_matchup is not None:
-            if not self.check_valid_matchup(info, matchup=FLAGS.race_matchup):
-                self.safe_escape()
+        if self.race_matchup is not None:
+            if not self.check_valid_matchup(info, matchup=self.race_matchup):
                 raise ValueError('Invalid matchup.')
 
         # Map name
@@ -156,8 +192,6 @@ class ReplayRunner(object):
             feature_layer=sc_pb.SpatialCameraSetup(width=24, allow_cheating_layers=True)
         )
 
-        self.screen_size = point.Point(*self.screen_size)
-        self.minimap_size = point.Point(*self.minimap_size)
         self.screen_size.assign_to(interface.feature_layer.resolution)
         self.minimap_size.assign_to(interface.feature_layer.minimap_resolution)
 
@@ -168,7 +202,9 @@ class ReplayRunner(object):
         self._episode_length = info.game_duration_loops
         self._episode_steps = 0
 
-        # Request replay
+        # Request replay; 'replay_data' is the same bytes object sent to
+        # replay_info above (protobuf copies bytes fields on assignment, so
+        # any intermediate cast here would double peak memory per replay).
         self.controller.start_replay(
             req_start_replay=sc_pb.RequestStartReplay(
                 replay_data=replay_data,
@@ -203,8 +239,10 @@ class ReplayRunner(object):
 
         while True:
 
-            # Take step, scale specified by 'step_mul' (sc_pb, RequestStep -> ResponseStep)
-            self.controller.step(self.step_mul)
+            # Take step, scale specified by 'step_mul' (sc_pb, RequestStep -> ResponseStep).
+            # Replays are non-interactive, so 'obs_every' sampled steps are
+            # batched into a single round-trip before observing.
+            self.controller.step(self.step_mul * self.obs_every)
 
             # Receive observation (sc_pb, RequestObservation -> ResponseObservation)
             obs = self.controller.observe()
@@ -222,7 +260,7 @@ class ReplayRunner(object):
                 self._state = environment.StepType.MID
                 discount = self.discount
 
-            self._episode_steps += self.step_mul
+            self._episode_steps += self.step_mul * self.obs_every
 
             step = environment.TimeStep(
                 step_type=self._state, reward=0,
@@ -235,23 +273,19 @@ class ReplayRunner(object):
             if self._state == environment.StepType.LAST:
                 break  # break out of while loop
 
-    @staticmethod
-    def check_valid_replay(info, ping):
-        """Check validity of replay."""
-        if info.HasField('error'):
-            logging.info('Has error.')
-            return False
-        elif info.base_build != ping.base_build:
-            logging.info('Different base build.')
-            return False
-        elif info.game_duration_loops < FLAGS.min_game_length:
-            logging.info('Game too short.')
-            return False
-        elif len(info.player_info) != 2:
-            logging.info('Not a game with two players.')
-            return False
-        else:
-            return True
+    def check_valid_replay(self, info, ping):
+        """Check validity of replay; cheapest field checks run first."""
+        checks = (
+            (lambda: info.HasField('error'), 'Has error.'),
+            (lambda: len(info.player_info) != 2, 'Not a game with two players.'),
+            (lambda: info.game_duration_loops < self.min_game_length, 'Game too short.'),
+            (lambda: info.base_build != ping.base_build, 'Different base build.'),
+        )
+        for failed, reason in checks:
+            if failed():
+                logging.info(reason)
+                return False
+        return True
 
     @staticmethod
     def get_player_meta_info(info):
@@ -298,9 +332,74 @@ class ReplayRunner(object):
         return compare(matchup_list, races_short)
 
     def safe_escape(self):
-        """Closes client."""
-        if self.controller.ping():
-            self.controller.quit()
+        """Closes client; tolerates an already-dead connection."""
+        try:
+            if self.controller.ping():
+                self.controller.quit()
+        except (protocol.ConnectionError, websocket.WebSocketException):
+            pass
+
+
+def iter_replay_files(root):
+    """Lazily yield paths to .SC2Replay files under 'root' (recursive)."""
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_replay_files(entry.path)
+        elif entry.name.endswith('.SC2Replay'):
+            yield entry.path
+
+
+def _init_worker():
+    """
+    Pool-worker initializer. Under the spawn start method workers begin
+    with unparsed absl flags, and pysc2 reads its own (--sc2_run_config,
+    --sc2_port, ...) when launching the SC2 client; mark the defaults as
+    parsed so those lookups succeed. No-op under fork.
+    """
+    if not FLAGS.is_parsed():
+        FLAGS([sys.argv[0]], known_only=True)
+
+
+# One SC2 process per (worker) process, reused across replays.
+_RUNNER = None
+
+
+def _shutdown_runner():
+    global _RUNNER
+    if _RUNNER is not None:
+        _RUNNER.safe_escape()
+        _RUNNER = None
+
+
+def parse_replay(replay_file, parser_objects, runner_kwargs):
+    """
+    Parse a single replay file. Runs in the main or a worker process;
+    'runner_kwargs' carries the flag values, since FLAGS is unparsed in
+    workers under the spawn start method.
+    """
+    global _RUNNER
+    try:
+        if _RUNNER is None:
+            _RUNNER = ReplayRunner(parser_objects=parser_objects, **runner_kwargs)
+            # atexit handlers never run in forked pool workers (they exit
+            # via os._exit); multiprocessing finalizers do, in fork, spawn,
+            # and the main process alike.
+            multiprocessing.util.Finalize(None, _shutdown_runner, exitpriority=0)
+        _RUNNER.load(replay_file)
+        _RUNNER.start()
+    except ValueError as e:
+        logging.info(str(e))
+    except ConnectionRefusedError as e:
+        # Connection is gone; drop the runner so the next call respawns SC2.
+        logging.info(str(e))
+        _RUNNER = None
+    except (protocol.ConnectionError, websocket.WebSocketException) as e:
+        # The SC2 client died mid-replay; same recovery as a refused spawn.
+        logging.info(str(e))
+        _RUNNER = None
+    except KeyboardInterrupt:
+        _shutdown_runner()
+        sys.exit()
 
 
 def main(argv):
@@ -315,46 +414,44 @@ def main(argv):
     # Get parser objects
     parser_objects = [ScreenFeatParser, MinimapFeatParser, SpatialFeatParser]
 
-    def _main(replay_file, parser_objs):
-        try:
-            runner = ReplayRunner(
-                replay_file_path=replay_file,
-                parser_objects=parser_objs,
-                screen_size=FLAGS.screen_size,
-                minimap_size=FLAGS.minimap_size,
-                discount=FLAGS.discount,
-                step_mul=FLAGS.step_mul,
-                override=FLAGS.override
-            )
-            runner.start()
-        except ValueError as e:
-            logging.info(str(e))
-        except ConnectionRefusedError as e:
-            logging.info(str(e))
-        except KeyboardInterrupt:
-            sys.exit()
-        finally:
-            try:
-                runner.safe_escape()
-            except UnboundLocalError:
-                pass
+    # Resolved once here; workers receive plain values, never FLAGS.
+    runner_kwargs = dict(
+        screen_size=FLAGS.screen_size,
+        minimap_size=FLAGS.minimap_size,
+        discount=FLAGS.discount,
+        step_mul=FLAGS.step_mul,
+        obs_every=FLAGS.obs_every,
+        override=FLAGS.override,
+        result_dir=FLAGS.result_dir,
+        race_matchup=FLAGS.race_matchup,
+        min_game_length=FLAGS.min_game_length,
+    )
 
     if FLAGS.replay_file is not None:
-        _main(FLAGS.replay_file, parser_objects)
+        parse_replay(FLAGS.replay_file, parser_objects, runner_kwargs)
     elif FLAGS.replay_dir is not None:
-        replay_files = glob.glob(os.path.join(FLAGS.replay_dir, '/**/*.SC2Replay'), recursive=True)
-        replay_files = replay_files[FLAGS.resume_from:]
-        for i, replay_file in enumerate(replay_files):
-            if i < FLAGS.resume_from:
-                continue
-            logging.info(
-                'Path to replay:\n{}'.format(replay_file.split()[-1])
-            )
-            _main(replay_file, parser_objects)
-            logging.info(
-                'Replay [{:>05d}/{:>05d}] terminating.'.format(i + 1, len(replay_files))
-            )
-            time.sleep(3.)
+        replay_files = itertools.islice(iter_replay_files(FLAGS.replay_dir), FLAGS.resume_from, None)
+        parse_one = functools.partial(parse_replay, parser_objects=parser_objects,
+                                      runner_kwargs=runner_kwargs)
+        if FLAGS.n_workers > 1:
+            # Replays are independent; shard them across processes, each of
+            # which spawns its own SC2 client.
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=FLAGS.n_workers, initializer=_init_worker) as executor:
+                for i, _ in enumerate(executor.map(parse_one, replay_files)):
+                    logging.info(
+                        'Replay [{:>05d}] terminating.'.format(i + 1)
+                    )
+        else:
+            for i, replay_file in enumerate(replay_files):
+                logging.info(
+                    'Path to replay:\n{}'.format(replay_file.split()[-1])
+                )
+                parse_one(replay_file)
+                logging.info(
+                    'Replay [{:>05d}] terminating.'.format(i + 1)
+                )
+                time.sleep(3.)
     else:
         raise NotImplementedError
 